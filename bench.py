@@ -0,0 +1,275 @@
+"""Бенчмарки на заглушках: python bench.py [hedge|fair|multibot|dedupe]"""
+import os
+import sys
+import subprocess
+import asyncio
+import random
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from main import (GeminiResponder, StubResponder, FairScheduler, MemoryManager,
+                  AdmissionController, BotServices)
+
+logging.disable(logging.ERROR)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def bench_hedge(requests=1000, concurrency=8):
+    """p50/p99 с хеджированием и без на двух моделях с медленным хвостом"""
+    def run(budget):
+        stubs = {
+            "stub-flash": StubResponder(latency=0.02, jitter=0.005, tail_rate=0.03, tail_latency=0.5),
+            "stub-flash-2": StubResponder(latency=0.03, jitter=0.005, tail_rate=0.03, tail_latency=0.5),
+        }
+        ai = GeminiResponder(None, models=list(stubs),
+                             call_model=lambda m, p: stubs[m].generate(p), max_workers=concurrency * 2)
+        ai.HEDGE_BUDGET = budget
+        ai.MIN_HEDGE_DELAY = 0.0
+
+        def one(i):
+            started = time.monotonic()
+            ai.generate(f"q{i}")
+            return time.monotonic() - started
+
+        with ThreadPoolExecutor(concurrency) as pool:
+            lat = list(pool.map(one, range(requests)))
+        ai.pool.shutdown(wait=True)
+        extra = sum(s.calls for s in stubs.values()) / requests - 1
+        return lat, ai.stats(), extra
+
+    for name, budget in (("no hedge", 0.0), ("hedged", GeminiResponder.HEDGE_BUDGET)):
+        lat, stats, extra = run(budget)
+        print(f"{name:9s} p50={percentile(lat, 0.5) * 1000:6.1f}ms "
+              f"p99={percentile(lat, 0.99) * 1000:6.1f}ms "
+              f"hedges={stats['hedges']} wins={stats['hedge_wins']} overhead={extra:.1%}")
+
+
+def bench_fair(heavy_users=16, regular_users=24, new_users=60, service=0.02, duration_new=0.02):
+    """Новые пользователи при перекошенной нагрузке через весь путь бота:
+    BotServices.admit (бюджет, admission, вытеснение) -> FairScheduler -> StubResponder.
+
+    Как в боте, у каждого uid не больше одного запроса в работе (user_locks).
+    "before" — прежняя связка: лимит admission 6 при 4 слотах и без вытеснения.
+    """
+    os.environ["AI_STUB"] = "1"
+
+    async def scenario(before):
+        services = BotServices()
+        services.ai = StubResponder(latency=service, jitter=service * 0.2)
+        if before:
+            services.admission.max_inflight = services.scheduler.slots + 2
+            services.scheduler.preempt = lambda uid: False
+        stop = asyncio.Event()
+        stats = {"new": [], "new_shed": 0, "active_shed": 0, "active": 0}
+
+        async def message(uid, kind):
+            started = time.monotonic()
+            level = services.admit(uid)
+            text = None
+            try:
+                if level <= AdmissionController.LITE:
+                    text = await services.generate(uid, "x" * 100)
+            finally:
+                services.admission.release(level)
+            served = bool(text)
+            if kind == "new":
+                if served:
+                    stats["new"].append(time.monotonic() - started)
+                else:
+                    stats["new_shed"] += 1
+            else:
+                stats["active"] += 1
+                stats["active_shed"] += not served
+            return served
+
+        async def user(uid, think):
+            while not stop.is_set():
+                await message(uid, "active")
+                await asyncio.sleep(random.uniform(service / 4, think))
+
+        loops = [asyncio.create_task(user(f"heavy{i}", service / 2)) for i in range(heavy_users)]
+        loops += [asyncio.create_task(user(f"user{i}", service * 20)) for i in range(regular_users)]
+        await asyncio.sleep(0.3)
+        newcomers = []
+        for i in range(new_users):
+            newcomers.append(asyncio.create_task(message(f"new{i}", "new")))
+            await asyncio.sleep(duration_new)
+        await asyncio.gather(*newcomers)
+        stop.set()
+        await asyncio.gather(*loops)
+        return stats
+
+    for name, before in (("before", True), ("after", False)):
+        stats = asyncio.run(scenario(before))
+        print(f"{name:6s} new users: shed={stats['new_shed']}/{new_users} "
+              f"p95={percentile(stats['new'], 0.95) * 1000:6.1f}ms | "
+              f"active users shed={stats['active_shed'] / max(1, stats['active']):.0%}")
+
+
+MULTIBOT_SCRIPT = """
+import os, sys, tracemalloc
+os.environ.update(API_ID="1", API_HASH="x", BOT_TOKEN="t", AI_STUB="1")
+
+def rss_kb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+
+import main
+n = int(sys.argv[1])
+tracemalloc.start()
+before = tracemalloc.get_traced_memory()[0]
+if n == 1:
+    bots = [main.TelegramAIBot()]
+else:
+    bots = main.MultiBotRunner([{"name": f"b{i}", "bot_token": str(i)} for i in range(n)]).bots
+print(rss_kb(), tracemalloc.get_traced_memory()[0] - before)
+"""
+
+
+def bench_multibot(n=8):
+    """RSS отдельного процесса на бота против прироста на бота в MultiBotRunner.
+
+    Считается на настоящих зависимостях из requirements.txt. TelegramClient создается,
+    но не подключается: сокеты и кэш сущностей живого клиента не учтены.
+    """
+    def measure(count):
+        out = subprocess.run([sys.executable, "-c", MULTIBOT_SCRIPT, str(count)],
+                             capture_output=True, text=True, check=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        rss, py = out.stdout.strip().splitlines()[-1].split()
+        return int(rss), int(py)
+
+    single_rss, single_py = measure(1)
+    shared_rss, shared_py = measure(n)
+    print(f"one bot per process:  {single_rss / 1024:6.1f} MB RSS per bot "
+          f"(bot objects {single_py / 1024:.0f} KB)")
+    print(f"{n} bots in one process: {shared_rss / 1024:6.1f} MB RSS total, "
+          f"+{(shared_py - single_py) / (n - 1) / 1024:.0f} KB Python heap per extra bot")
+
+
+# (первое сообщение, второе сообщение, почти повтор?)
+# DEDUPE_SAMPLES использовались для подбора DUP_THRESHOLD, DEDUPE_HELDOUT — нет
+DEDUPE_SAMPLES = [
+    ("подскажи как настроить vpn на телефоне", "подскажи как настроить vpn на телефоне?", True),
+    ("подскажи как настроить vpn на телефоне", "подскажи пожалуйста как настроить впн на телефоне", True),
+    ("у меня не работает wifi после обновления", "у меня после обновления не работает wifi", True),
+    ("ты знаеш кто твой создател?", "ты знаешь кто твой создатель?", True),
+    ("ты знаеш кто твой создател?", "ты знаешь кто твой создатель", True),
+    ("как защитить аккаунт телеграм от взлома", "как защитить аккаунт в телеграм от взлома??", True),
+    ("iltimos yordam bering parolni unutdim", "iltimos yordam bering, parolni unutib qoydim", True),
+    ("Bahrom aka salom qalaysiz ishlar yaxshimi", "Bahrom aka salom, qalaysiz? ishlar yaxshimi", True),
+    ("что такое sql инъекция и как от нее защититься", "что такое sql инъекции и как от них защититься", True),
+    ("мне пришло странное письмо со ссылкой от банка", "мне пришло странное письмо от банка со ссылкой", True),
+    ("посоветуй хороший антивирус для windows", "посоветуй хороший антивирус для windows 11", True),
+    ("как поменять пароль от почты gmail", "как поменять пароль от почты gmail быстро", True),
+    ("подскажи как настроить vpn на телефоне", "подскажи как настроить роутер дома", False),
+    ("у меня не работает wifi после обновления", "у меня не работает камера после обновления", False),
+    ("ты знаеш кто твой создател?", "ты знаешь что такое фишинг?", False),
+    ("как защитить аккаунт телеграм от взлома", "как взломали аккаунт моего друга в инстаграм", False),
+    ("iltimos yordam bering parolni unutdim", "iltimos yordam bering telefon qotib qoldi", False),
+    ("что такое sql инъекция и как от нее защититься", "что такое xss и как работает csrf токен", False),
+    ("посоветуй хороший антивирус для windows", "посоветуй хороший ноутбук для учебы", False),
+    ("мне пришло странное письмо со ссылкой от банка", "мне позвонили якобы из банка и просят код", False),
+    ("как поменять пароль от почты gmail", "как включить двухфакторку в gmail", False),
+    ("Bahrom aka salom qalaysiz ishlar yaxshimi", "Bahrom aka kompyuter sekin ishlayapti nima qilay", False),
+    ("какой язык программирования учить первым", "какой язык программирования лучше для хакинга", False),
+    ("как проверить сайт на уязвимости бесплатно", "как проверить флешку на вирусы бесплатно", False),
+]
+
+
+DEDUPE_HELDOUT = [
+    ("как узнать кто заходил в мой инстаграм", "как узнать кто заходил в мой инстаграм??", True),
+    ("можешь проверить эту ссылку на фишинг", "можешь проверить вот эту ссылку на фишинг", True),
+    ("у меня телефон греется и быстро садится", "у меня телефон сильно греется и быстро садится", True),
+    ("где скачать kali linux безопасно", "где безопасно скачать kali linux", True),
+    ("bahrom aka menga python organishni maslahat bering", "bahrom aka menga python organish boyicha maslahat bering", True),
+    ("что делать если взломали вк", "что делать если взломали мой вк", True),
+    ("сколько времени нужно чтобы выучить сети", "сколько времени нужно чтобы выучить компьютерные сети", True),
+    ("какой пароль считается надежным", "какой пароль считается надежным?", True),
+    ("мой аккаунт гугл заблокировали после входа", "мой гугл аккаунт заблокировали после входа", True),
+    ("scammer menga pul yubor deb yozyapti", "scammer menga pul yubor deb yozyapti nima qilay", True),
+    ("нужна помощь с настройкой firewall на сервере", "нужна помощь с настройкой фаервола на сервере", True),
+    ("посоветуй курсы по пентесту для новичка", "посоветуй курсы по пентесту для новичков", True),
+    ("как узнать кто заходил в мой инстаграм", "как удалить аккаунт в инстаграм навсегда", False),
+    ("можешь проверить эту ссылку на фишинг", "можешь объяснить что такое ddos атака", False),
+    ("у меня телефон греется и быстро садится", "у меня ноутбук шумит и тормозит в играх", False),
+    ("где скачать kali linux безопасно", "где скачать windows 10 бесплатно", False),
+    ("bahrom aka menga python organishni maslahat bering", "bahrom aka menga linux kerakmi yoki yoq", False),
+    ("что делать если взломали вк", "что делать если украли телефон", False),
+    ("сколько времени нужно чтобы выучить сети", "сколько стоит сертификат cisco ccna", False),
+    ("какой пароль считается надежным", "какой менеджер паролей лучше", False),
+    ("мой аккаунт гугл заблокировали после входа", "мой аккаунт телеграм зашел с другого устройства", False),
+    ("scammer menga pul yubor deb yozyapti", "menga notanish raqamdan qongiroq qilishdi", False),
+    ("нужна помощь с настройкой firewall на сервере", "нужна помощь с настройкой nginx на сервере", False),
+    ("посоветуй курсы по пентесту для новичка", "посоветуй книги по пентесту для новичка", False),
+]
+
+
+# цепочка, где каждый шаг похож на предыдущий, но последний далек от первого:
+# слияния должны сравниваться с сохраненным текстом, а не с последним повтором
+DEDUPE_CHAIN = (
+    ["подскажи как настроить vpn на телефоне",
+     "подскажи как настроить vpn на телефоне дома",
+     "подскажи как настроить роутер на телефоне дома",
+     "подскажи как настроить роутер дома быстро"],
+    2,
+)
+
+
+def bench_dedupe(inserts=2000):
+    """Точность дедупликации на примерах и стоимость update() с подписями и без"""
+    def score(pairs):
+        tp = fp = fn = tn = 0
+        for a, b, dup in pairs:
+            sim = MemoryManager.similarity(MemoryManager.signature(a), MemoryManager.signature(b))
+            found = sim >= MemoryManager.DUP_THRESHOLD
+            tp += found and dup
+            fp += found and not dup
+            fn += dup and not found
+            tn += not dup and not found
+        return (f"pairs={len(pairs)} precision={tp / max(1, tp + fp):.2f} "
+                f"recall={tp / max(1, tp + fn):.2f} (tp={tp} fp={fp} fn={fn} tn={tn})")
+
+    print(f"tuning   {score(DEDUPE_SAMPLES)}")
+    print(f"held-out {score(DEDUPE_HELDOUT)}")
+
+    async def chain():
+        memory = MemoryManager(filename=os.devnull)
+        for text in DEDUPE_CHAIN[0]:
+            await memory.update(1, text)
+        return memory
+
+    memory = asyncio.run(chain())
+    facts = memory.data["1"]["facts"]
+    # после рестарта подписи строятся из текста: должны совпасть с текущими
+    consistent = memory.signatures["1"] == [MemoryManager.signature(x["text"]) for x in facts]
+    print(f"chain facts={len(facts)} expected={DEDUPE_CHAIN[1]} "
+          f"scores={[x['score'] for x in facts]} signatures_match_text={consistent}")
+
+    texts = [x for pair in DEDUPE_SAMPLES for x in pair[:2]]
+
+    async def fill(memory):
+        started = time.perf_counter()
+        for i in range(inserts):
+            await memory.update(i % 10, texts[i % len(texts)])
+        return (time.perf_counter() - started) / inserts
+
+    for name, dedupe in (("plain", False), ("minhash", True)):
+        memory = MemoryManager(filename=os.devnull, dedupe=dedupe)
+        cost = asyncio.run(fill(memory))
+        stored = sum(len(x["facts"]) for x in memory.data.values())
+        print(f"{name:8s} insert={cost * 1e6:7.1f}us facts stored={stored}")
+
+
+BENCHES = {"hedge": bench_hedge, "fair": bench_fair, "multibot": bench_multibot, "dedupe": bench_dedupe}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHES)
+    for name in names:
+        print(f"== {name}")
+        BENCHES[name]()
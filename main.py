@@ -6,7 +6,16 @@ import random
 import logging
 import re
 import threading
+import heapq
+import itertools
+import zlib
+import cProfile
+import pstats
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FuturesTimeout
 from datetime import timedelta
+from functools import partial
+from contextlib import contextmanager
 from flask import Flask
 from telethon import TelegramClient, events
 from telethon.sessions import StringSession
@@ -54,9 +63,20 @@ def humanize(text):
 # 3. КЛАСС MemoryManager
 # ===========================================
 class MemoryManager:
-    def __init__(self, filename="memory.json"):
+    # MinHash из 32 хешей; у пользователя не больше 20 фактов, поэтому вместо
+    # LSH-индекса — прямой проход по подписям: полосы при таком размере ничего не отсекают
+    MINHASH_SIZE = 32
+    DUP_THRESHOLD = 0.65
+    MAX_SCORE = 10
+    _PRIME = (1 << 61) - 1
+    _rng = random.Random(1337)
+    _PERMS = list(zip(_rng.sample(range(1, _PRIME), MINHASH_SIZE), _rng.sample(range(_PRIME), MINHASH_SIZE)))
+
+    def __init__(self, filename="memory.json", dedupe=True):
         self.filename = filename
         self.data = {}
+        self.signatures = {}
+        self.dedupe = dedupe
         self.lock = asyncio.Lock()
         self.dirty = False
         self.load()
@@ -69,24 +89,89 @@ class MemoryManager:
             except Exception as e:
                 logger.error(f"Memory load error: {e}")
                 self.data = {}
+        self.signatures = {}
+
+    # ---------- MinHash ----------
+    @staticmethod
+    def _shingles(text, k=3):
+        t = re.sub(r"\W+", " ", text.lower()).strip()
+        if len(t) <= k:
+            return {t}
+        return {t[i:i + k] for i in range(len(t) - k + 1)}
+
+    @classmethod
+    def signature(cls, text):
+        hashes = [zlib.crc32(x.encode("utf-8")) for x in cls._shingles(text)]
+        p = cls._PRIME
+        return tuple(min((a * h + b) % p for h in hashes) for a, b in cls._PERMS)
+
+    @classmethod
+    def similarity(cls, sig_a, sig_b):
+        return sum(1 for x, y in zip(sig_a, sig_b) if x == y) / cls.MINHASH_SIZE
+
+    @staticmethod
+    def _fact_text(item):
+        if isinstance(item, dict):
+            return item.get("text", "")
+        return item if isinstance(item, str) else ""
+
+    def _user_signatures(self, uid):
+        # подписи не сохраняются в файл: строим лениво и держим параллельно списку facts
+        facts = self.data[uid]["facts"]
+        sigs = self.signatures.get(uid)
+        if sigs is None or len(sigs) != len(facts):
+            sigs = [self.signature(self._fact_text(x)) for x in facts]
+            self.signatures[uid] = sigs
+        return sigs
+
+    def find_duplicate(self, uid, sig):
+        best, best_sim = None, self.DUP_THRESHOLD
+        for i, other in enumerate(self._user_signatures(uid)):
+            sim = self.similarity(sig, other)
+            if sim >= best_sim:
+                best, best_sim = i, sim
+        return best
 
     async def update(self, uid, text):
         if len(text) < 20:
             return
         uid = str(uid)
+        score = 1
+        if "?" in text:
+            score += 1
+        if len(text) > 80:
+            score += 1
+        text = text[:160]
+        # подпись считаем до захвата lock: это самая дорогая часть вставки
+        sig = self.signature(text) if self.dedupe else None
         async with self.lock:
             self.data.setdefault(uid, {"facts": []})
-            score = 1
-            if "?" in text:
-                score += 1
-            if len(text) > 80:
-                score += 1
-            self.data[uid]["facts"].append({
-                "text": text[:160],
+            facts = self.data[uid]["facts"]
+
+            if self.dedupe:
+                sigs = self._user_signatures(uid)
+                dup = self.find_duplicate(uid, sig)
+                if dup is not None:
+                    # почти повтор: поднимаем старый факт вместо нового, подпись — от его текста
+                    item = facts.pop(dup)
+                    sigs.append(sigs.pop(dup))
+                    if isinstance(item, str):
+                        item = {"text": item, "score": 1, "ts": 0}
+                    item["score"] = min(self.MAX_SCORE, item.get("score", 1) + 1)
+                    item["ts"] = time.time()
+                    facts.append(item)
+                    self.dirty = True
+                    return
+
+            facts.append({
+                "text": text,
                 "score": score,
                 "ts": time.time()
             })
-            self.data[uid]["facts"] = self.data[uid]["facts"][-20:]
+            self.data[uid]["facts"] = facts[-20:]
+            if self.dedupe:
+                sigs.append(sig)
+                self.signatures[uid] = sigs[-20:]
             self.dirty = True
 
     async def autosave_loop(self):
@@ -116,6 +201,25 @@ class MemoryManager:
         normalized = sorted(normalized, key=lambda x: x["score"], reverse=True)[:5]
         return "\n".join(x["text"] for x in normalized)
 
+    def namespace(self, name):
+        return NamespacedMemory(self, name) if name else self
+
+class NamespacedMemory:
+    """Память одного бота в общем MemoryManager: ключи вида "<бот>:<uid>" """
+
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+
+    def _key(self, uid):
+        return f"{self.name}:{uid}"
+
+    async def update(self, uid, text):
+        await self.store.update(self._key(uid), text)
+
+    def get_text(self, uid):
+        return self.store.get_text(self._key(uid))
+
 # ===========================================
 # 4. КЛАСС StyleManager
 # ===========================================
@@ -154,39 +258,538 @@ class StyleManager:
 # 5. КЛАСС GeminiResponder
 # ===========================================
 class GeminiResponder:
-    def __init__(self, api_key):
-        genai.configure(api_key=api_key)
-        self.model_name = self._pick_model()
+    HEDGE_PERCENTILE = 0.9
+    HEDGE_BUDGET = 0.1
+    MIN_HEDGE_DELAY = 0.5
+    REQUEST_TIMEOUT = 20
+    OUTCOME_WINDOW = 20
+    STALE_SECONDS = 60
 
-    def _pick_model(self):
+    def __init__(self, api_key, models=None, call_model=None, max_workers=8, clock=time.monotonic):
+        if call_model is None:
+            genai.configure(api_key=api_key)
+        self.call_model = call_model or self._call_gemini
+        self.clock = clock
+        self.models = list(models) if models else self._pick_models()
+        self.latencies = {m: deque(maxlen=100) for m in self.models}
+        self.outcomes = {m: deque(maxlen=self.OUTCOME_WINDOW) for m in self.models}
+        self.last_call = {m: 0.0 for m in self.models}
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.stats_lock = threading.Lock()
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def _pick_models(self):
         models = []
         for m in genai.list_models():
             methods = getattr(m, "supported_generation_methods", [])
             if "generateContent" in methods:
                 models.append(m.name)
         flash = [m for m in models if "flash" in m]
-        return flash[0] if flash else models[0] if models else None
+        return flash + [m for m in models if m not in flash]
+
+    def _call_gemini(self, model_name, prompt):
+        # таймаут на сам HTTP-запрос: иначе зависший вызов держит поток бесконечно
+        r = genai.GenerativeModel(model_name).generate_content(
+            prompt, request_options={"timeout": self.REQUEST_TIMEOUT})
+        return r.text if r and r.text else ""
+
+    def _timed_call(self, model_name, prompt):
+        started = self.clock()
+        try:
+            text = self.call_model(model_name, prompt)
+        except Exception as e:
+            logger.error(f"Gemini generation error ({model_name}): {e}")
+            text = ""
+        with self.stats_lock:
+            # задержку пишем только для успехов: мгновенный 429 не должен делать модель "быстрой"
+            if text:
+                self.latencies[model_name].append(self.clock() - started)
+            self.outcomes[model_name].append(bool(text))
+            self.last_call[model_name] = self.clock()
+        return text
+
+    def _percentile(self, model_name, q):
+        lat = sorted(self.latencies[model_name])
+        if len(lat) < 10:
+            return None
+        return lat[min(len(lat) - 1, int(len(lat) * q))]
+
+    def _error_rate(self, model_name):
+        outcomes = self.outcomes[model_name]
+        if outcomes and self.clock() - self.last_call[model_name] >= self.STALE_SECONDS:
+            # модель давно не вызывали: забываем старые ошибки, следующий вызов ее проверит
+            outcomes.clear()
+        if not outcomes:
+            return 0.0
+        return sum(1 for ok in outcomes if not ok) / len(outcomes)
+
+    def ranked_models(self):
+        """Сначала по доле ошибок в окне (с шагом 10%), потом по медианной задержке"""
+        def key(m):
+            median = self._percentile(m, 0.5)
+            return (round(self._error_rate(m), 1), median if median is not None else float("inf"))
+        with self.stats_lock:
+            return sorted(self.models, key=key)
+
+    def _take_hedge(self):
+        """Хедж разрешен, пока дублей не больше HEDGE_BUDGET от всех запросов"""
+        with self.stats_lock:
+            if self.hedges >= self.HEDGE_BUDGET * self.requests:
+                return False
+            self.hedges += 1
+            return True
+
+    def stats(self):
+        with self.stats_lock:
+            return {
+                "requests": self.requests,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "models": {m: {"p50": self._percentile(m, 0.5),
+                               "p90": self._percentile(m, 0.9),
+                               "error_rate": round(self._error_rate(m), 3)} for m in self.models},
+            }
 
     def generate(self, prompt):
-        if not self.model_name:
+        if not self.models:
             logger.error("No Gemini model available")
             return ""
-        model = genai.GenerativeModel(self.model_name)
+        ranked = self.ranked_models()
+        primary = ranked[0]
+        with self.stats_lock:
+            self.requests += 1
+            hedge_delay = self._percentile(primary, self.HEDGE_PERCENTILE)
+        if len(ranked) < 2 or hedge_delay is None:
+            return self._timed_call(primary, prompt)
+
+        first = self.pool.submit(self._timed_call, primary, prompt)
         try:
-            r = model.generate_content(prompt)
-            return r.text if r and r.text else ""
-        except Exception as e:
-            logger.error(f"Gemini generation error: {e}")
+            text = first.result(timeout=max(hedge_delay, self.MIN_HEDGE_DELAY))
+        except FuturesTimeout:
+            text = None
+        if text is not None:
+            if text or not self._take_hedge():
+                return text
+            # основная модель вернула пустой ответ: одна попытка на запасной
+            return self._timed_call(ranked[1], prompt)
+        if not self._take_hedge():
+            return first.result()
+
+        second = self.pool.submit(self._timed_call, ranked[1], prompt)
+        pending = {first, second}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for f in done:
+                text = f.result()
+                if text:
+                    if f is second:
+                        with self.stats_lock:
+                            self.hedge_wins += 1
+                    # поток нельзя прервать: проигравший дорабатывает, результат выбрасывается
+                    for loser in pending:
+                        loser.cancel()
+                    return text
+        return ""
+
+# ===========================================
+# 5.1 КЛАСС StubResponder (для тестов и нагрузки)
+# ===========================================
+class StubResponder:
+    """Заглушка вместо Gemini: задержка, хвост и ошибки задаются на лету"""
+
+    def __init__(self, latency=0.05, jitter=0.0, error_rate=0.0, reply="ок, понял",
+                 tail_rate=0.0, tail_latency=0.0, sleep=time.sleep):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.reply = reply
+        self.tail_rate = tail_rate
+        self.tail_latency = tail_latency
+        self.sleep = sleep
+        self.calls = 0
+
+    def generate(self, prompt):
+        self.calls += 1
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if random.random() < self.tail_rate:
+            delay += self.tail_latency
+        self.sleep(max(0.0, delay))
+        if random.random() < self.error_rate:
+            logger.error("Stub generation error (injected)")
             return ""
+        return self.reply
+
+    def call_model(self, model_name, prompt):
+        # совместимо с GeminiResponder(call_model=...)
+        return self.generate(prompt)
+
+# ===========================================
+# 5.2 КЛАСС AdmissionController
+# ===========================================
+class AdmissionController:
+    """Следит за задержкой, ошибками и очередью LLM и решает, как отвечать"""
+
+    NORMAL, LITE, CACHED, SHED = 0, 1, 2, 3
+    LEVEL_NAMES = {0: "normal", 1: "lite", 2: "cached", 3: "shed"}
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    BUSY_REPLY = "Сейчас завал, напиши чуть позже 🙏"
+    CANNED_REPLIES = [
+        "Секунду, сейчас немного занят, скоро вернусь к этому",
+        "Понял тебя, отвечу подробнее чуть позже",
+        "Принял, дай пару минут",
+    ]
+
+    def __init__(self, window=40, min_samples=5, max_inflight=6, lite_latency=6.0,
+                 cached_latency=15.0, lite_error_rate=0.2, open_error_rate=0.5,
+                 open_seconds=30, timeout=25, cache_size=200, clock=time.monotonic):
+        self.samples = deque(maxlen=window)
+        self.min_samples = min_samples
+        self.max_inflight = max_inflight
+        self.lite_latency = lite_latency
+        self.cached_latency = cached_latency
+        self.lite_error_rate = lite_error_rate
+        self.open_error_rate = open_error_rate
+        self.open_seconds = open_seconds
+        self.timeout = timeout
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.clock = clock
+
+        self.inflight = 0
+        self.abandoned = 0
+        self.breaker = self.CLOSED
+        self.opened_at = 0.0
+        self.probing = False
+        self.level = self.NORMAL
+        self.counters = {name: 0 for name in self.LEVEL_NAMES.values()}
+        self.counters.update(timeouts=0, errors=0, breaker_trips=0)
+
+    # ---------- метрики ----------
+    def latency(self):
+        lat = sorted(x[0] for x in self.samples)
+        if not lat:
+            return 0.0
+        return lat[min(len(lat) - 1, int(len(lat) * 0.9))]
+
+    def error_rate(self):
+        if not self.samples:
+            return 0.0
+        return sum(1 for x in self.samples if not x[1]) / len(self.samples)
+
+    def snapshot(self):
+        return {
+            "level": self.LEVEL_NAMES[self.level],
+            "breaker": self.breaker,
+            "inflight": self.inflight,
+            "abandoned": self.abandoned,
+            "p90_latency": round(self.latency(), 3),
+            "error_rate": round(self.error_rate(), 3),
+            "samples": len(self.samples),
+            "cache": len(self.cache),
+            "counters": dict(self.counters),
+        }
+
+    # ---------- состояние ----------
+    def _set_level(self, level):
+        if level != self.level:
+            logger.warning(f"Admission level {self.LEVEL_NAMES[self.level]} -> "
+                           f"{self.LEVEL_NAMES[level]}: {self.snapshot()}")
+            self.level = level
+
+    def _set_breaker(self, state):
+        if state != self.breaker:
+            logger.warning(f"Circuit breaker {self.breaker} -> {state}")
+            self.breaker = state
+            if state == self.OPEN:
+                self.opened_at = self.clock()
+                self.counters["breaker_trips"] += 1
+            if state == self.CLOSED:
+                self.samples.clear()
+
+    def _compute_level(self, preempted=False):
+        if self.breaker == self.OPEN and self.clock() - self.opened_at >= self.open_seconds:
+            self._set_breaker(self.HALF_OPEN)
+        if self.inflight + self.abandoned >= self.max_inflight and not preempted:
+            return self.SHED
+        if self.breaker == self.OPEN:
+            return self.CACHED
+        if self.breaker == self.HALF_OPEN:
+            # пропускаем ровно один пробный запрос
+            return self.CACHED if self.probing else self.LITE
+        if len(self.samples) < self.min_samples:
+            return self.NORMAL
+        lat, err = self.latency(), self.error_rate()
+        if lat >= self.cached_latency:
+            return self.CACHED
+        if lat >= self.lite_latency or err >= self.lite_error_rate:
+            return self.LITE
+        return self.NORMAL
+
+    def admit(self, preempted=False):
+        """Возвращает уровень деградации для нового сообщения.
+
+        preempted=True — планировщик уже вытеснил из очереди чужой запрос ради этого,
+        его слот освободится в release() вытесненного, поэтому лимит inflight не проверяем.
+        """
+        level = self._compute_level(preempted)
+        self._set_level(level)
+        self.counters[self.LEVEL_NAMES[level]] += 1
+        if level <= self.LITE:
+            self.inflight += 1
+            if self.breaker == self.HALF_OPEN:
+                self.probing = True
+        return level
+
+    def release(self, level):
+        """Парная к admit(): вызывать в finally при любом исходе, включая отмену"""
+        if level > self.LITE:
+            return
+        self.inflight = max(0, self.inflight - 1)
+        if self.inflight == 0 and self.probing:
+            # проба не дошла до record() (отмена/исключение): разрешаем новую
+            self.probing = False
+        self._set_level(self._compute_level())
+
+    def record(self, latency, ok):
+        self.samples.append((latency, ok))
+        if not ok:
+            self.counters["errors"] += 1
+        if self.breaker == self.HALF_OPEN and self.probing:
+            self.probing = False
+            self._set_breaker(self.CLOSED if ok else self.OPEN)
+        elif self.breaker == self.CLOSED and len(self.samples) >= self.min_samples:
+            if self.error_rate() >= self.open_error_rate:
+                self._set_breaker(self.OPEN)
+        self._set_level(self._compute_level())
+
+    async def run(self, fn, prompt):
+        """Генерация в потоке с таймаутом и учетом задержки; слот освобождает release()"""
+        started = self.clock()
+        future = asyncio.ensure_future(asyncio.to_thread(fn, prompt))
+        try:
+            text = await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            self.counters["timeouts"] += 1
+            logger.error(f"LLM timeout after {self.timeout}s")
+            self._abandon(future)
+            text = ""
+        except asyncio.CancelledError:
+            self._abandon(future)
+            raise
+        except Exception as e:
+            logger.error(f"LLM call failed: {e}")
+            text = ""
+        self.record(self.clock() - started, bool(text))
+        return text
+
+    def _abandon(self, future):
+        # поток нельзя прервать: он занимает место в inflight, пока реально не вернется
+        if future.done():
+            return
+        self.abandoned += 1
+        future.add_done_callback(self._abandoned_done)
+
+    def _abandoned_done(self, future):
+        self.abandoned -= 1
+        if not future.cancelled():
+            future.exception()
+        self._set_level(self._compute_level())
+
+    # ---------- кэш ответов ----------
+    @staticmethod
+    def _cache_key(scope, text):
+        # scope = (бот, uid): ответ собран с памятью этого пользователя, чужим его не отдаем
+        return scope, re.sub(r"\W+", " ", text.lower()).strip()
+
+    def remember(self, scope, incoming, reply):
+        key = self._cache_key(scope, incoming)
+        self.cache[key] = reply
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def cached_reply(self, scope, incoming, canned=True):
+        reply = self.cache.get(self._cache_key(scope, incoming))
+        if reply:
+            return reply
+        return random.choice(self.CANNED_REPLIES) if canned else ""
+
+# ===========================================
+# 5.3 КЛАСС FairScheduler
+# ===========================================
+class FairScheduler:
+    """Справедливая очередь к LLM (start-time fair queuing) с весами и бюджетами"""
+
+    def __init__(self, slots=4, weights=None, token_budget=None, budget_window=3600,
+                 share_window=60, clock=time.monotonic):
+        self.slots = slots
+        self.weights = weights or {}
+        self.token_budget = token_budget
+        self.budget_window = budget_window
+        self.share_window = share_window
+        self.clock = clock
+
+        self.busy = 0
+        self.preempted = 0
+        self.vtime = 0.0
+        self.finish = {}
+        self.queue = []
+        self.seq = itertools.count()
+        self.usage = {}
+        self.served = {}
+        self.waits = {}
+        self.new_waits = deque(maxlen=500)
+        self.all_waits = deque(maxlen=2000)
+
+    def weight(self, uid):
+        return self.weights.get(uid, 1.0)
+
+    def recent_share(self, uid):
+        """Сколько раз uid обслужили за share_window, деленное на вес.
+
+        У пользователя в боте не больше одного запроса в работе, поэтому теги SFQ
+        у ожидающих почти всегда равны; недавняя доля разбивает ничьи и выбирает,
+        кого вытеснять.
+        """
+        served = self.served.get(uid)
+        if not served:
+            return 0.0
+        threshold = self.clock() - self.share_window
+        while served and served[0] < threshold:
+            served.popleft()
+        return len(served) / self.weight(uid)
+
+    def _dispatched(self, uid, waited):
+        self.served.setdefault(uid, deque()).append(self.clock())
+        self._record_wait(uid, waited)
+
+    # ---------- бюджеты ----------
+    def _prune(self, uid):
+        usage = self.usage.get(uid)
+        if not usage:
+            return 0
+        threshold = self.clock() - self.budget_window
+        while usage and usage[0][0] < threshold:
+            usage.popleft()
+        return sum(x[1] for x in usage)
+
+    def within_budget(self, uid):
+        if not self.token_budget:
+            return True
+        return self._prune(uid) < self.token_budget * self.weight(uid)
+
+    def charge(self, uid, tokens):
+        if self.token_budget:
+            self.usage.setdefault(uid, deque()).append((self.clock(), tokens))
+
+    # ---------- очередь ----------
+    def _record_wait(self, uid, waited):
+        if uid not in self.waits:
+            self.new_waits.append(waited)
+        self.waits.setdefault(uid, deque(maxlen=50)).append(waited)
+        self.all_waits.append(waited)
+
+    async def acquire(self, uid):
+        """True — слот получен, False — запрос вытеснен из очереди через preempt()"""
+        start = max(self.vtime, self.finish.get(uid, 0.0))
+        self.finish[uid] = start + 1.0 / self.weight(uid)
+        if self.busy < self.slots and not self.queue:
+            self.busy += 1
+            self.vtime = start
+            self._dispatched(uid, 0.0)
+            return True
+        fut = asyncio.get_running_loop().create_future()
+        entry = (start, self.recent_share(uid), next(self.seq), uid, fut, self.clock())
+        heapq.heappush(self.queue, entry)
+        try:
+            return await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                if fut.result():
+                    self.release()
+            else:
+                self._drop(entry)
+            raise
+
+    def _drop(self, entry):
+        if entry in self.queue:
+            self.queue.remove(entry)
+            heapq.heapify(self.queue)
+
+    def preempt(self, uid):
+        """Очередь полна: вытесняет запрос с наибольшими (тег, недавняя доля),
+        если у нового запроса от uid они меньше. True — место освобождено."""
+        if not self.queue:
+            return False
+        victim = max(self.queue)
+        start = max(self.vtime, self.finish.get(uid, 0.0))
+        if victim[:2] <= (start, self.recent_share(uid)):
+            return False
+        self._drop(victim)
+        victim_uid, fut = victim[3], victim[4]
+        # запрос не обслужен: возвращаем пользователю его долю виртуального времени
+        self.finish[victim_uid] = max(self.vtime, self.finish.get(victim_uid, 0.0) - 1.0 / self.weight(victim_uid))
+        self.preempted += 1
+        fut.set_result(False)
+        return True
+
+    def release(self):
+        self.busy -= 1
+        while self.busy < self.slots and self.queue:
+            start, _, _, uid, fut, enqueued = heapq.heappop(self.queue)
+            if fut.done():
+                continue
+            self.busy += 1
+            self.vtime = start
+            self._dispatched(uid, self.clock() - enqueued)
+            fut.set_result(True)
+
+    async def run(self, uid, fn, prompt):
+        """Ждет свой слот, вызывает await fn(prompt) и списывает токены с бюджета.
+        Возвращает None, если запрос вытеснили из очереди."""
+        if not await self.acquire(uid):
+            return None
+        try:
+            text = await fn(prompt)
+        finally:
+            self.release()
+        self.charge(uid, (len(prompt) + len(text or "")) // 4)
+        return text
+
+    def forget(self, uid):
+        self.finish.pop(uid, None)
+        self.usage.pop(uid, None)
+        self.served.pop(uid, None)
+        self.waits.pop(uid, None)
+
+    @staticmethod
+    def _p95(values):
+        values = sorted(values)
+        return round(values[min(len(values) - 1, int(len(values) * 0.95))], 3) if values else 0.0
+
+    def snapshot(self, top=5):
+        slowest = sorted(self.waits.items(), key=lambda x: self._p95(x[1]), reverse=True)[:top]
+        return {
+            "busy": self.busy,
+            "queued": len(self.queue),
+            "preempted": self.preempted,
+            "p95_wait": self._p95(self.all_waits),
+            "p95_wait_new_users": self._p95(self.new_waits),
+            "p95_wait_by_user": {str(uid): self._p95(w) for uid, w in slowest},
+        }
 
 # ===========================================
 # 6. КЛАСС UserDataCleaner
 # ===========================================
 class UserDataCleaner:
-    def __init__(self, user_last, dialog_until, user_locks, max_age_hours=24):
+    def __init__(self, user_last, dialog_until, user_locks, on_forget=None, max_age_hours=24):
         self.user_last = user_last
         self.dialog_until = dialog_until
         self.user_locks = user_locks
+        self.on_forget = on_forget
         self.max_age = timedelta(hours=max_age_hours)
 
     async def cleanup_loop(self):
@@ -201,9 +804,146 @@ class UserDataCleaner:
                 lock = self.user_locks.get(uid)
                 if lock and not lock.locked():
                     self.user_locks.pop(uid, None)
+                if self.on_forget:
+                    self.on_forget(uid)
             if to_remove:
                 logger.info(f"Cleaned up {len(to_remove)} inactive users")
 
+# ===========================================
+# 6.1 КЛАСС MessageTracer
+# ===========================================
+class Trace:
+    """Спаны одного сообщения; без сэмплирования ничего не записывает"""
+
+    def __init__(self, tracer, sampled, **attrs):
+        self.tracer = tracer
+        self.sampled = sampled
+        self.attrs = attrs
+        self.trace_id = f"{random.getrandbits(64):016x}" if sampled else None
+        self.started = time.perf_counter()
+        self.spans = []
+
+    @contextmanager
+    def span(self, name):
+        if not self.sampled:
+            yield
+            return
+        start = time.perf_counter()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            item = {
+                "name": name,
+                "start_ms": round((start - self.started) * 1000, 2),
+                "duration_ms": round((time.perf_counter() - start) * 1000, 2),
+            }
+            if error:
+                item["error"] = error
+            self.spans.append(item)
+
+    def finish(self, **attrs):
+        if not self.sampled:
+            return
+        self.attrs.update(attrs)
+        self.tracer.export({
+            "trace_id": self.trace_id,
+            "ts": time.time(),
+            "duration_ms": round((time.perf_counter() - self.started) * 1000, 2),
+            **self.attrs,
+            "spans": self.spans,
+        })
+
+class MessageTracer:
+    """Копит трассы в памяти и раз в несколько секунд дописывает их в файл из потока"""
+
+    SKIP_OUTCOMES = {"filtered"}
+
+    def __init__(self, filename="traces.jsonl", sample_rate=0.0, max_bytes=10 * 1024 * 1024,
+                 buffer_size=1000):
+        self.filename = filename
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.buffer = deque(maxlen=buffer_size)
+        self.dropped = 0
+
+    def start(self, **attrs):
+        return Trace(self, random.random() < self.sample_rate, **attrs)
+
+    def export(self, record):
+        if record.get("outcome") in self.SKIP_OUTCOMES:
+            return
+        if len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1
+        self.buffer.append(json.dumps(record, ensure_ascii=False))
+
+    def _write(self, lines):
+        # один архив traces.jsonl.1: на диске не больше ~2 * max_bytes плюс одна пачка
+        if os.path.exists(self.filename) and os.path.getsize(self.filename) >= self.max_bytes:
+            os.replace(self.filename, self.filename + ".1")
+        with open(self.filename, "a", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+    async def flush(self):
+        if not self.buffer:
+            return
+        lines = list(self.buffer)
+        self.buffer.clear()
+        try:
+            await asyncio.to_thread(self._write, lines)
+        except Exception as e:
+            logger.error(f"Trace export error: {e}")
+
+    async def flush_loop(self, interval=5):
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush()
+
+# ===========================================
+# 6.2 КЛАСС RuntimeProfiler
+# ===========================================
+class RuntimeProfiler:
+    """cProfile на N секунд по команде владельца, результат в папку profiles/"""
+
+    MAX_SECONDS = 300
+
+    def __init__(self, directory="profiles"):
+        self.directory = directory
+        self.task = None
+
+    @property
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+    def start(self, seconds):
+        """Профилирует поток event loop; код в asyncio.to_thread сюда не попадает"""
+        if self.running:
+            return None
+        seconds = max(1, min(int(seconds), self.MAX_SECONDS))
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, time.strftime("profile-%Y%m%d-%H%M%S"))
+        profiler = cProfile.Profile()
+        profiler.enable()
+        self.task = asyncio.create_task(self._stop_after(profiler, seconds, path))
+        logger.info(f"Profiler started for {seconds}s -> {path}.prof")
+        return path
+
+    async def _stop_after(self, profiler, seconds, path):
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+            try:
+                profiler.dump_stats(path + ".prof")
+                with open(path + ".txt", "w", encoding="utf-8") as f:
+                    pstats.Stats(profiler, stream=f).sort_stats("cumulative").print_stats(40)
+                logger.info(f"Profiler results saved to {path}.prof")
+            except Exception as e:
+                logger.error(f"Profiler dump error: {e}")
+
 # ===========================================
 # 7. КЛАСС TelegramAIBot (ИСПРАВЛЕННЫЙ)
 # ===========================================
@@ -212,33 +952,42 @@ class TelegramAIBot:
     USER_COOLDOWN = 5
     DIALOG_GRACE = 240
 
-    def __init__(self):
+    def __init__(self, bot_token=None, session_string=None, name=None, services=None):
         self.api_id = int(os.getenv("API_ID", "0"))
         self.api_hash = os.getenv("API_HASH")
-        self.bot_token = os.getenv("BOT_TOKEN")
+        self.bot_token = bot_token or os.getenv("BOT_TOKEN")
+        self.name = name
 
         if not self.api_id or not self.api_hash or not self.bot_token:
             raise ValueError("Missing ENV variables")
 
         # ИСПРАВЛЕНИЕ: Используем StringSession вместо файла
-        from telethon.sessions import StringSession
-        session_string = os.getenv("SESSION_STRING", "")
-        if session_string:
+        self.session_string = session_string if session_string is not None else os.getenv("SESSION_STRING", "")
+        if self.session_string:
             # Если есть сохраненная сессия, используем её
-            self.client = TelegramClient(StringSession(session_string), self.api_id, self.api_hash)
+            self.client = TelegramClient(StringSession(self.session_string), self.api_id, self.api_hash)
         else:
             # Если нет, создаем новую сессию в памяти
             self.client = TelegramClient(StringSession(), self.api_id, self.api_hash)
-        
-        self.memory = MemoryManager()
-        self.style = StyleManager()
-        self.ai = GeminiResponder(os.getenv("GEMINI_API_KEY"))
+
+        # Общие ресурсы: свои для одиночного бота, общие в MultiBotRunner
+        self.owns_services = services is None
+        self.services = services or BotServices()
+        self.memory = self.services.memory.namespace(name)
+        self.style = self.services.style
+        self.ai = self.services.ai
+        self.admission = self.services.admission
+        self.scheduler = self.services.scheduler
+        self.tracer = self.services.tracer
+        self.profiler = self.services.profiler
 
         self.my_id = None
         self.user_last = {}
         self.dialog_until = {}
         self.user_locks = {}
-        self.cleaner = UserDataCleaner(self.user_last, self.dialog_until, self.user_locks)
+        self.services.bots.append(self)
+        self.cleaner = UserDataCleaner(self.user_last, self.dialog_until, self.user_locks,
+                                       on_forget=self.services.forget_user)
 
     def name_called(self, text):
         t = text.lower()
@@ -273,42 +1022,19 @@ class TelegramAIBot:
                 await asyncio.sleep(2 ** attempt)
         return None
 
-    async def on_message(self, event):
-        if not event.is_private:
-            return
-        if event.out or event.sender_id == self.my_id:
-            return
-
-        sender = await event.get_sender()
-        if sender and getattr(sender, "bot", False):
-            return
-        if event.via_bot_id:
-            return
-
-        incoming = (event.raw_text or "").strip()
-        if len(incoming) < 3:
-            return
-
-        uid = event.sender_id
-        now = time.time()
-
-        if OWNER_ID and uid == OWNER_ID:
-            self.style.save_line(incoming)
+    def build_prompt(self, uid, incoming, lite=False):
+        emotion = detect_emotion(incoming)
+        if lite:
+            # облегченный промпт при перегрузке: без стиля и памяти
+            return f"""
+Ты — Бахром, эксперт по кибербезопасности. Не говори что ты ИИ. Никогда не матерись.
+Ответь коротко, тон: {emotion}.
 
-        direct = await self.is_direct(event, incoming)
-        if direct:
-            self.dialog_until[uid] = now + self.DIALOG_GRACE
-        elif now > self.dialog_until.get(uid, 0):
-            return
-        if now - self.user_last.get(uid, 0) < self.USER_COOLDOWN:
-            return
-
-        lock = self.user_locks.setdefault(uid, asyncio.Lock())
-        async with lock:
-            memory = self.memory.get_text(uid)
-            emotion = detect_emotion(incoming)
-
-            prompt = f"""
+ВОПРОС:
+{incoming}
+"""
+        memory = self.memory.get_text(uid)
+        return f"""
 Ты — Бахром, эксперт по кибербезопасности.
 Твое имя Бахром.
 Не говори что ты ИИ.
@@ -329,22 +1055,108 @@ class TelegramAIBot:
 ВОПРОС:
 {incoming}
 """
-            text = await asyncio.to_thread(self.ai.generate, prompt)
+
+    async def owner_command(self, event, text):
+        """/profile [сек] — cProfile на N секунд, /trace <доля> — частота трассировки"""
+        parts = text.split()
+        if parts[0] == "/profile":
+            seconds = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 30
+            path = self.profiler.start(seconds)
+            reply = f"Профилирую, результат: {path}.prof" if path else "Профайлер уже запущен"
+        elif parts[0] == "/trace":
+            try:
+                self.tracer.sample_rate = min(1.0, max(0.0, float(parts[1])))
+            except (IndexError, ValueError):
+                pass
+            reply = f"Трассировка: {self.tracer.sample_rate:.0%} сообщений -> {self.tracer.filename}"
+        else:
+            return False
+        await self.send_with_retry(event.chat_id, reply, reply_to=event.id)
+        return True
+
+    async def on_message(self, event):
+        # группы и свои сообщения отсекаем до трассы: их большинство, и они ничего не стоят
+        if not event.is_private:
+            return
+        if event.out or event.sender_id == self.my_id:
+            return
+        trace = self.tracer.start(bot=self.name, chat_id=event.chat_id)
+        outcome = "error"
+        try:
+            outcome = await self.handle_message(event, trace)
+        finally:
+            trace.finish(outcome=outcome)
+
+    async def handle_message(self, event, trace):
+        with trace.span("sender"):
+            sender = await event.get_sender()
+        with trace.span("filter_sender"):
+            if sender and getattr(sender, "bot", False):
+                return "filtered"
+            if event.via_bot_id:
+                return "filtered"
+
+            incoming = (event.raw_text or "").strip()
+            if len(incoming) < 3:
+                return "filtered"
+
+        uid = event.sender_id
+        now = time.time()
+
+        if OWNER_ID and uid == OWNER_ID:
+            if incoming.startswith("/") and await self.owner_command(event, incoming):
+                return "command"
+            self.style.save_line(incoming)
+
+        with trace.span("is_direct"):
+            direct = await self.is_direct(event, incoming)
+        if direct:
+            self.dialog_until[uid] = now + self.DIALOG_GRACE
+        elif now > self.dialog_until.get(uid, 0):
+            return "not_direct"
+        if now - self.user_last.get(uid, 0) < self.USER_COOLDOWN:
+            return "cooldown"
+
+        lock = self.user_locks.setdefault(uid, asyncio.Lock())
+        async with lock:
+            level = self.services.admit(uid)
+            trace.attrs["level"] = AdmissionController.LEVEL_NAMES[level]
+            try:
+                if level == AdmissionController.SHED:
+                    text = AdmissionController.BUSY_REPLY
+                elif level == AdmissionController.CACHED:
+                    text = self.admission.cached_reply((self.name, uid), incoming)
+                else:
+                    with trace.span("prompt"):
+                        prompt = self.build_prompt(uid, incoming, lite=level == AdmissionController.LITE)
+                    with trace.span("generate"):
+                        text = await self.services.generate(uid, prompt)
+                    if text is None:
+                        text = AdmissionController.BUSY_REPLY
+                    elif text:
+                        self.admission.remember((self.name, uid), incoming, text)
+                    else:
+                        text = self.admission.cached_reply((self.name, uid), incoming, canned=False)
+            finally:
+                self.admission.release(level)
             if not text:
                 logger.info(f"Empty response for user {uid}, skipping")
-                return
+                return "empty"
 
             text = humanize(text)
 
             try:
-                async with self.client.action(event.chat_id, "typing"):
-                    await self.adaptive_typing_delay(text)
-                await self.send_with_retry(event.chat_id, text, reply_to=event.id)
+                with trace.span("typing"):
+                    async with self.client.action(event.chat_id, "typing"):
+                        await self.adaptive_typing_delay(text)
+                with trace.span("send"):
+                    await self.send_with_retry(event.chat_id, text, reply_to=event.id)
             except Exception as e:
                 logger.exception(f"Failed to send message: {e}")
 
             await self.memory.update(uid, incoming)
             self.user_last[uid] = now
+        return "replied"
 
     async def run(self):
         while True:
@@ -355,19 +1167,124 @@ class TelegramAIBot:
                 self.my_id = me.id
                 
                 # Сохраняем строку сессии для будущих запусков (полезно при первом запуске)
-                if not os.getenv("SESSION_STRING"):
+                if not self.session_string:
                     session_string = self.client.session.save()
-                    logger.info(f"✨ СОХРАНИТЕ ЭТУ СТРОКУ В ПЕРЕМЕННУЮ SESSION_STRING: {session_string}")
+                    logger.info(f"✨ СОХРАНИТЕ ЭТУ СТРОКУ В ПЕРЕМЕННУЮ SESSION_STRING "
+                                f"({self.name or 'BOT_TOKEN'}): {session_string}")
                 
-                asyncio.create_task(self.memory.autosave_loop())
+                if self.owns_services:
+                    self.services.start_background()
                 asyncio.create_task(self.cleaner.cleanup_loop())
-                logger.info("✅ BOT STARTED SUCCESSFULLY!")
+                logger.info(f"✅ BOT STARTED SUCCESSFULLY! {self.name or ''}")
                 self.client.add_event_handler(self.on_message, events.NewMessage(incoming=True))
                 await self.client.run_until_disconnected()
             except Exception as e:
                 logger.exception(f"❌ Bot crashed: {e}")
                 await asyncio.sleep(5)
 
+# ===========================================
+# 7.1 КЛАСС BotServices
+# ===========================================
+class BotServices:
+    """Ресурсы, которые можно делить между несколькими ботами в одном процессе"""
+
+    def __init__(self):
+        self.memory = MemoryManager()
+        self.style = StyleManager()
+        if os.getenv("AI_STUB"):
+            self.ai = StubResponder()
+        else:
+            self.ai = GeminiResponder(os.getenv("GEMINI_API_KEY"))
+        weights = {OWNER_ID: float(os.getenv("OWNER_WEIGHT", "4"))} if OWNER_ID else {}
+        slots = int(os.getenv("LLM_SLOTS", "4"))
+        self.scheduler = FairScheduler(
+            slots=slots,
+            weights=weights,
+            token_budget=int(os.getenv("USER_TOKEN_BUDGET", "0")) or None,
+        )
+        # лимит admission = слоты + реальная очередь, чтобы порядок решал планировщик
+        self.admission = AdmissionController(max_inflight=slots + int(os.getenv("LLM_QUEUE", "8")))
+        self.tracer = MessageTracer(
+            filename=os.getenv("TRACE_FILE", "traces.jsonl"),
+            sample_rate=float(os.getenv("TRACE_SAMPLE", "0")),
+            max_bytes=int(os.getenv("TRACE_MAX_MB", "10")) * 1024 * 1024,
+        )
+        self.profiler = RuntimeProfiler()
+        self.tasks = []
+        self.bots = []
+
+    def admit(self, uid):
+        """Уровень для сообщения uid с учетом бюджета; при полной очереди
+        вытесняет самого задолжавшего пользователя вместо новичка"""
+        if not self.scheduler.within_budget(uid):
+            logger.info(f"Token budget exceeded for user {uid}")
+            return AdmissionController.CACHED
+        level = self.admission.admit()
+        if level == AdmissionController.SHED and self.scheduler.preempt(uid):
+            level = self.admission.admit(preempted=True)
+        return level
+
+    async def generate(self, uid, prompt):
+        """None — запрос вытеснили из очереди ради другого пользователя"""
+        return await self.scheduler.run(uid, partial(self.admission.run, self.ai.generate), prompt)
+
+    def forget_user(self, uid):
+        # планировщик общий: чистим состояние uid, только если его не помнит ни один бот
+        if not any(uid in bot.user_last or uid in bot.user_locks for bot in self.bots):
+            self.scheduler.forget(uid)
+
+    def start_background(self):
+        if not self.tasks:
+            self.tasks = [
+                asyncio.create_task(self.memory.autosave_loop()),
+                asyncio.create_task(self.stats_loop()),
+                asyncio.create_task(self.tracer.flush_loop()),
+            ]
+
+    async def stats_loop(self, interval=300):
+        while True:
+            await asyncio.sleep(interval)
+            logger.info(f"LLM stats: admission={self.admission.snapshot()} "
+                        f"scheduler={self.scheduler.snapshot()}")
+
+# ===========================================
+# 7.2 КЛАСС MultiBotRunner
+# ===========================================
+def load_bot_configs(value=None):
+    """BOTS_CONFIG: путь к JSON-файлу или сам JSON — список {name, bot_token, session_string}"""
+    value = value or os.getenv("BOTS_CONFIG", "")
+    if os.path.exists(value):
+        with open(value, "r", encoding="utf-8") as f:
+            configs = json.load(f)
+    else:
+        configs = json.loads(value)
+    if not isinstance(configs, list) or not configs:
+        raise ValueError("BOTS_CONFIG must be a non-empty list")
+    names = [c.get("name") for c in configs]
+    if len(set(names)) != len(names):
+        raise ValueError("Bot names in BOTS_CONFIG must be unique")
+    return configs
+
+class MultiBotRunner:
+    """Несколько аккаунтов на одном event loop с общими LLM, кэшами и памятью"""
+
+    def __init__(self, configs):
+        self.services = BotServices()
+        self.bots = [
+            TelegramAIBot(
+                bot_token=c["bot_token"],
+                session_string=c.get("session_string", ""),
+                name=c.get("name"),
+                services=self.services,
+            )
+            for c in configs
+        ]
+
+    async def run(self):
+        self.services.start_background()
+        logger.info(f"Starting {len(self.bots)} bots in one process")
+        await asyncio.gather(*(bot.run() for bot in self.bots))
+
 # ===========================================
 # 8. ФУНКЦИЯ run_with_reconnect
 # ===========================================
@@ -378,7 +1295,10 @@ async def run_with_reconnect():
     
     for attempt in range(max_retries):
         try:
-            bot = TelegramAIBot()
+            if os.getenv("BOTS_CONFIG"):
+                bot = MultiBotRunner(load_bot_configs())
+            else:
+                bot = TelegramAIBot()
             await bot.run()
             break
         except Exception as e:
@@ -0,0 +1,19 @@
+import pytest
+
+
+class FakeClock:
+    """Ручные часы для классов с параметром clock; sleep() двигает их вместо ожидания"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
@@ -0,0 +1,153 @@
+import asyncio
+
+import pytest
+
+from main import AdmissionController, StubResponder
+
+NORMAL, LITE, CACHED, SHED = (AdmissionController.NORMAL, AdmissionController.LITE,
+                              AdmissionController.CACHED, AdmissionController.SHED)
+
+
+def make(clock, **kwargs):
+    params = dict(min_samples=3, max_inflight=3, lite_latency=5, cached_latency=10,
+                  lite_error_rate=0.2, open_error_rate=0.5, open_seconds=30, clock=clock)
+    params.update(kwargs)
+    return AdmissionController(**params)
+
+
+def call(ac, stub):
+    """Один полный цикл сообщения: admit -> run -> release"""
+    level = ac.admit()
+    try:
+        if level <= LITE:
+            asyncio.run(ac.run(stub.generate, "prompt"))
+    finally:
+        ac.release(level)
+    return level
+
+
+def test_normal_when_fast_and_healthy(clock):
+    ac = make(clock)
+    stub = StubResponder(latency=1, sleep=clock.sleep)
+    assert [call(ac, stub) for _ in range(5)] == [NORMAL] * 5
+    assert ac.breaker == AdmissionController.CLOSED
+
+
+def test_slow_llm_degrades_to_lite_then_cached(clock):
+    ac = make(clock)
+    stub = StubResponder(latency=6, sleep=clock.sleep)
+    for _ in range(3):
+        call(ac, stub)
+    assert ac.admit() == LITE
+    ac.release(LITE)
+
+    stub.latency = 12
+    for _ in range(3):
+        call(ac, stub)
+    assert ac.admit() == CACHED
+    assert ac.snapshot()["level"] == "cached"
+
+
+def test_errors_below_breaker_threshold_give_lite(clock):
+    ac = make(clock, open_error_rate=0.9)
+    stub = StubResponder(latency=1, sleep=clock.sleep)
+    for _ in range(3):
+        call(ac, stub)
+    stub.error_rate = 1.0
+    call(ac, stub)
+    assert ac.error_rate() == pytest.approx(0.25)
+    assert ac.admit() == LITE
+    assert ac.breaker == AdmissionController.CLOSED
+
+
+def test_shed_when_inflight_is_full(clock):
+    ac = make(clock, max_inflight=2)
+    first, second = ac.admit(), ac.admit()
+    assert ac.admit() == SHED
+    ac.release(first)
+    assert ac.admit() == NORMAL
+    assert ac.counters["shed"] == 1
+    ac.release(second)
+
+
+def test_breaker_open_half_open_closed(clock):
+    ac = make(clock)
+    stub = StubResponder(latency=1, error_rate=1.0, sleep=clock.sleep)
+    for _ in range(3):
+        call(ac, stub)
+    assert ac.breaker == AdmissionController.OPEN
+    assert ac.admit() == CACHED
+
+    clock.now += 30
+    probe = ac.admit()
+    assert probe == LITE
+    assert ac.breaker == AdmissionController.HALF_OPEN
+    # пока идет проба, остальные получают кэш
+    assert ac.admit() == CACHED
+
+    stub.error_rate = 0.0
+    asyncio.run(ac.run(stub.generate, "prompt"))
+    ac.release(probe)
+    assert ac.breaker == AdmissionController.CLOSED
+    assert ac.admit() == NORMAL
+    assert ac.counters["breaker_trips"] == 1
+
+
+def test_failed_probe_reopens_breaker(clock):
+    ac = make(clock)
+    stub = StubResponder(latency=1, error_rate=1.0, sleep=clock.sleep)
+    for _ in range(3):
+        call(ac, stub)
+    clock.now += 30
+    assert call(ac, stub) == LITE
+    assert ac.breaker == AdmissionController.OPEN
+    assert ac.admit() == CACHED
+
+
+def test_cancelled_probe_does_not_pin_breaker(clock):
+    ac = make(clock)
+    stub = StubResponder(latency=1, error_rate=1.0, sleep=clock.sleep)
+    for _ in range(3):
+        call(ac, stub)
+    clock.now += 30
+    probe = ac.admit()
+    # проба отменена до run(): слот и флаг пробы должны освободиться
+    ac.release(probe)
+    assert ac.inflight == 0
+    assert ac.admit() == LITE
+
+
+def test_timeout_counts_as_error(clock):
+    ac = make(clock, timeout=0.01)
+    stub = StubResponder(latency=0.2)
+    level = ac.admit()
+    assert asyncio.run(ac.run(stub.generate, "prompt")) == ""
+    ac.release(level)
+    assert ac.counters["timeouts"] == 1
+    assert ac.error_rate() == 1.0
+
+
+def test_reply_cache_is_scoped_per_user():
+    ac = AdmissionController()
+    ac.remember(("bot", 1), "Что ты помнишь обо мне?", "ты любишь python")
+    assert ac.cached_reply(("bot", 1), "что ты помнишь обо мне") == "ты любишь python"
+    assert ac.cached_reply(("bot", 2), "что ты помнишь обо мне", canned=False) == ""
+    assert ac.cached_reply(("other", 1), "что ты помнишь обо мне", canned=False) == ""
+
+
+def test_abandoned_thread_counts_as_inflight_until_it_returns(clock):
+    ac = make(clock, max_inflight=1, timeout=0.01)
+    stub = StubResponder(latency=0.2)
+
+    async def scenario():
+        level = ac.admit()
+        assert await ac.run(stub.generate, "prompt") == ""
+        ac.release(level)
+        # слот вернули, но поток еще висит в generate: новых вызовов не пускаем
+        assert ac.snapshot()["abandoned"] == 1
+        assert ac.admit() == SHED
+        await asyncio.sleep(0.3)
+        assert ac.abandoned == 0
+        assert ac.admit() == NORMAL
+
+    asyncio.run(scenario())
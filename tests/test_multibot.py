@@ -0,0 +1,43 @@
+import asyncio
+
+import pytest
+
+from main import MultiBotRunner
+
+
+@pytest.fixture
+def runner(monkeypatch):
+    monkeypatch.setenv("API_ID", "1")
+    monkeypatch.setenv("API_HASH", "hash")
+    monkeypatch.setenv("AI_STUB", "1")
+    # TelegramClient привязывается к event loop при создании
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield MultiBotRunner([{"name": "a", "bot_token": "1"}, {"name": "b", "bot_token": "2"}])
+    asyncio.set_event_loop(None)
+    loop.close()
+
+
+def test_bots_share_services_with_namespaced_memory(runner, tmp_path):
+    a, b = runner.bots
+    assert a.ai is b.ai and a.scheduler is b.scheduler
+    runner.services.memory.filename = str(tmp_path / "memory.json")
+    runner.services.memory.data = {}
+    asyncio.get_event_loop().run_until_complete(a.memory.update(5, "я работаю сетевым инженером"))
+    assert b.memory.get_text(5) == ""
+    assert "a:5" in runner.services.memory.data
+
+
+def test_cleaner_keeps_scheduler_state_for_user_active_on_other_bot(runner):
+    a, b = runner.bots
+    runner.services.scheduler.finish[7] = 3.0
+    a.user_last[7] = 0
+    b.user_last[7] = 10**12
+
+    a.user_last.pop(7)
+    a.cleaner.on_forget(7)
+    assert 7 in runner.services.scheduler.finish
+
+    b.user_last.pop(7)
+    b.cleaner.on_forget(7)
+    assert 7 not in runner.services.scheduler.finish
@@ -0,0 +1,61 @@
+from main import GeminiResponder
+
+
+def make(clock, endpoints):
+    return GeminiResponder(None, models=list(endpoints),
+                           call_model=lambda m, p: endpoints[m](p), clock=clock)
+
+
+def test_failing_model_is_demoted_then_retried(clock):
+    state = {"flash_up": False}
+    endpoints = {
+        "flash": lambda p: "flash" if state["flash_up"] else "",
+        "pro": lambda p: "pro",
+        "lite": lambda p: "lite",
+    }
+    ai = make(clock, endpoints)
+    ai.generate("q")
+    assert ai.ranked_models()[-1] == "flash"
+    assert ai.generate("q") == "pro"
+
+    # модель восстановилась: после паузы старые ошибки забываются и она снова первая
+    state["flash_up"] = True
+    clock.now += GeminiResponder.STALE_SECONDS
+    assert ai.generate("q") == "flash"
+    assert ai.stats()["models"]["flash"]["error_rate"] == 0.0
+    assert ai.ranked_models()[0] == "flash"
+
+
+def test_model_failing_again_after_cooldown_stays_demoted(clock):
+    ai = make(clock, {"flash": lambda p: "", "pro": lambda p: "pro"})
+    ai.generate("q")
+    clock.now += GeminiResponder.STALE_SECONDS
+    ai.generate("q")
+    assert ai.stats()["models"]["flash"]["error_rate"] == 1.0
+    assert ai.generate("q") == "pro"
+
+
+def test_model_failing_every_other_call_loses_primary(clock):
+    calls = {"flash": 0}
+
+    def flash(prompt):
+        calls["flash"] += 1
+        return "flash" if calls["flash"] % 2 else ""
+
+    ai = make(clock, {"flash": flash, "pro": lambda p: "pro"})
+    results = [ai.generate("q") for _ in range(400)]
+    assert ai.ranked_models()[0] == "pro"
+    assert results.count("") <= 1
+
+
+def test_failed_calls_do_not_lower_median_latency(clock):
+
+    def slow_ok(prompt):
+        clock.now += 2.0
+        return "ok"
+
+    ai = make(clock, {"flash": lambda p: "", "pro": slow_ok})
+    for _ in range(20):
+        ai.generate("q")
+    assert ai.stats()["models"]["flash"]["p50"] is None
+    assert ai.ranked_models()[0] == "pro"
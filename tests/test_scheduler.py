@@ -0,0 +1,92 @@
+import asyncio
+
+from main import FairScheduler
+
+
+def test_token_budget_uses_sliding_window(clock):
+    s = FairScheduler(token_budget=100, budget_window=60, weights={"owner": 2.0}, clock=clock)
+    s.charge("u", 80)
+    clock.now = 30
+    s.charge("u", 30)
+    assert not s.within_budget("u")
+    # первое списание выходит из окна
+    clock.now = 61
+    assert s.within_budget("u")
+
+    s.charge("owner", 150)
+    assert s.within_budget("owner")
+
+
+def test_new_user_is_served_before_backlogged_user():
+    order = []
+
+    async def scenario():
+        s = FairScheduler(slots=1)
+        gate = asyncio.Event()
+
+        async def llm(prompt):
+            order.append(prompt)
+            await gate.wait()
+            return "ok"
+
+        first = asyncio.create_task(s.run("busy", llm, "busy-1"))
+        await asyncio.sleep(0)
+        tasks = [asyncio.create_task(s.run("busy", llm, f"busy-{i}")) for i in (2, 3)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(s.run("new", llm, "new-1")))
+        await asyncio.sleep(0)
+        gate.set()
+        await asyncio.gather(first, *tasks)
+
+    asyncio.run(scenario())
+    assert order[:2] == ["busy-1", "new-1"]
+
+
+def test_preempt_evicts_most_backlogged_request_for_newcomer():
+    async def scenario():
+        s = FairScheduler(slots=1)
+        gate = asyncio.Event()
+
+        async def llm(prompt):
+            await gate.wait()
+            return prompt
+
+        running = asyncio.create_task(s.run("busy", llm, "busy-1"))
+        await asyncio.sleep(0)
+        queued = [asyncio.create_task(s.run("busy", llm, f"busy-{i}")) for i in (2, 3)]
+        await asyncio.sleep(0)
+
+        assert s.preempt("new")
+        newcomer = asyncio.create_task(s.run("new", llm, "new-1"))
+        await asyncio.sleep(0)
+        # тот же пользователь с уже большим тегом никого не вытесняет
+        assert not s.preempt("busy")
+
+        gate.set()
+        return await asyncio.gather(running, *queued, newcomer)
+
+    results = asyncio.run(scenario())
+    assert results == ["busy-1", "busy-2", None, "new-1"]
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def scenario():
+        s = FairScheduler(slots=1)
+        gate = asyncio.Event()
+
+        async def llm(prompt):
+            await gate.wait()
+            return prompt
+
+        running = asyncio.create_task(s.run("a", llm, "a"))
+        await asyncio.sleep(0)
+        waiting = asyncio.create_task(s.run("b", llm, "b"))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        assert s.queue == []
+        gate.set()
+        await running
+        assert s.busy == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,40 @@
+import asyncio
+import json
+
+from main import MessageTracer
+
+
+def test_sampled_trace_is_buffered_then_flushed(tmp_path):
+    tracer = MessageTracer(filename=str(tmp_path / "traces.jsonl"), sample_rate=1.0)
+    trace = tracer.start(bot="a")
+    with trace.span("sender"):
+        pass
+    with trace.span("filter_sender"):
+        pass
+    trace.finish(outcome="replied")
+    assert not (tmp_path / "traces.jsonl").exists()
+
+    asyncio.run(tracer.flush())
+    record = json.loads((tmp_path / "traces.jsonl").read_text(encoding="utf-8"))
+    assert record["outcome"] == "replied"
+    assert [x["name"] for x in record["spans"]] == ["sender", "filter_sender"]
+
+
+def test_filtered_and_unsampled_traces_are_not_exported():
+    tracer = MessageTracer(sample_rate=1.0)
+    tracer.start().finish(outcome="filtered")
+    tracer.sample_rate = 0.0
+    tracer.start().finish(outcome="replied")
+    assert len(tracer.buffer) == 0
+
+
+def test_trace_file_is_rotated_at_max_bytes(tmp_path):
+    path = tmp_path / "traces.jsonl"
+    tracer = MessageTracer(filename=str(path), sample_rate=1.0, max_bytes=200)
+    for _ in range(3):
+        for _ in range(5):
+            tracer.start().finish(outcome="replied")
+        asyncio.run(tracer.flush())
+    # каждая пачка больше лимита: после ротации в текущем файле только последняя
+    assert (tmp_path / "traces.jsonl.1").exists()
+    assert len(path.read_text(encoding="utf-8").splitlines()) == 5